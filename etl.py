@@ -1,46 +1,91 @@
 import configparser
 import os
-from datetime import datetime
+from pyspark import StorageLevel, __version__ as pyspark_version
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, monotonically_increasing_id
+from pyspark.sql.functions import col, dayofmonth, expr, hour, month, weekofyear, year
 from pyspark.sql.types import StructType, StructField, StringType, DoubleType, IntegerType, LongType
 
-
-def process_song_data(spark, input_data, output_data):
+# song data schema
+SONG_DATA_SCHEMA = StructType([
+    StructField("artist_id", StringType()),
+    StructField("artist_latitude", DoubleType()),
+    StructField("artist_location", StringType()),
+    StructField("artist_longitude", DoubleType()),
+    StructField("artist_name", StringType()),
+    StructField("duration", DoubleType()),
+    StructField("num_songs", IntegerType()),
+    StructField("song_id", StringType()),
+    StructField("title", StringType()),
+    StructField("year", IntegerType())
+])
+
+# log data schema
+LOG_DATA_SCHEMA = StructType([
+    StructField("artist", StringType()),
+    StructField("auth", StringType()),
+    StructField("firstName", StringType()),
+    StructField("gender", StringType()),
+    StructField("itemInSession", IntegerType()),
+    StructField("lastName", StringType()),
+    StructField("length", DoubleType()),
+    StructField("level", StringType()),
+    StructField("location", StringType()),
+    StructField("method", StringType()),
+    StructField("page", StringType()),
+    StructField("registration", DoubleType()),
+    StructField("sessionId", IntegerType()),
+    StructField("song", StringType()),
+    StructField("status", IntegerType()),
+    StructField("ts", LongType()),
+    StructField("userAgent", StringType()),
+    StructField("userId", StringType()),
+])
+
+
+def process_song_data(spark, df_song_data, output_data):
     """
     This function processes song data, applies necessary filters and outputs necessary tables to specified path.
 
     Args:
         spark: spark session
-        input_data: path to input data
+        df_song_data: song data dataframe
         output_data: path to output data
 
     Returns:
         None
     """
-    print("Started processing song data from input path " + input_data)
-    df_song_data = get_song_data_df(input_data, spark)
+    print("Started processing song data")
 
     # prepare view to use SparkSQL with
+    # song data is persisted by the caller, so songs and artists queries share a single scan of it
     df_song_data.createOrReplaceTempView("staging_songs")
 
-    # extract columns to create songs table
-    songs = spark.sql("""SELECT DISTINCT song_id, title AS song_title, artist_id, year, duration 
+    # extract columns to create songs table, one row per song
+    # songs where year == 0 are dropped before aggregation as it is not a valid year
+    songs = spark.sql("""SELECT song_id, 
+                                FIRST(title) AS song_title, 
+                                FIRST(artist_id) AS artist_id, 
+                                FIRST(year) AS year, 
+                                FIRST(duration) AS duration 
                             FROM staging_songs
+                            WHERE year <> 0
+                            GROUP BY song_id
     """)
 
-    # drop songs where year == 0 as it is not a valid year
-    songs = songs.filter(songs.year != 0)
-
-    # write songs table to parquet files partitioned by year and artist
-    songs.write.partitionBy("year", "artist_id").parquet(
+    # write songs table to parquet files partitioned by year and artist, one file per partition
+    songs.repartition("year", "artist_id").write.partitionBy("year", "artist_id").parquet(
         path=output_data + "/songs/",
         mode="overwrite")
 
-    # extract columns to create artists table
+    # extract columns to create artists table, one row per artist
     artists = spark.sql("""
-                            SELECT DISTINCT artist_id, artist_name, artist_location, artist_latitude, artist_longitude 
+                            SELECT  artist_id, 
+                                    FIRST(artist_name) AS artist_name, 
+                                    FIRST(artist_location) AS artist_location, 
+                                    FIRST(artist_latitude) AS artist_latitude, 
+                                    FIRST(artist_longitude) AS artist_longitude 
                             FROM staging_songs
+                            GROUP BY artist_id
     """)
 
     # write artists table to parquet files
@@ -49,78 +94,78 @@ def process_song_data(spark, input_data, output_data):
         mode="overwrite")
 
 
-def process_log_data(spark, input_data, output_data):
+def process_log_data(spark, df_song_data, df_log_data, output_data):
     """
     This function processes log data, applies necessary filters and outputs necessary tables to specified path.
 
     Args:
         spark: spark session
-        input_data: path to input data
+        df_song_data: song data dataframe
+        df_log_data: log data dataframe
         output_data: path to output data
 
     Returns:
         None
     """
-    print("Started processing log data from input path " + input_data)
-    df_log_data = get_log_data_df(input_data, spark)
-
-    # filter by actions for song plays
-    df_log_data = df_log_data.filter(df_log_data.page == "NextSong")
+    print("Started processing log data")
 
     # enrich timestamp and datetime columns
     df_log_data = enrich_log_data(df_log_data)
 
+    # persist and materialize enriched log data, as users, time and songplays tables are all built from it
+    df_log_data = df_log_data.persist(StorageLevel.MEMORY_AND_DISK)
+    df_log_data.count()
+
     # prepare view to use SparkSQL with
     df_log_data.createOrReplaceTempView("staging_logs")
 
-    # extract columns for users table
+    # extract columns for users table, keeping only the latest record of each user
     users = spark.sql("""
-                        SELECT  staging_logs_left.userId, 
-                                staging_logs_left.level, 
-                                staging_logs_left.firstName, 
-                                staging_logs_left.lastName, 
-                                staging_logs_left.gender
-                        FROM staging_logs staging_logs_left
-                        INNER JOIN (SELECT userId, 
-                                            MAX(timestamp) AS maxtimestamp
-                                            FROM staging_logs 
-                                            GROUP BY userId, page) staging_logs_right 
-                        ON staging_logs_left.userId = staging_logs_right.userId 
-                        AND staging_logs_left.timestamp = staging_logs_right.maxtimestamp
+                        SELECT  userId, 
+                                level, 
+                                firstName, 
+                                lastName, 
+                                gender
+                        FROM (SELECT userId, 
+                                     level, 
+                                     firstName, 
+                                     lastName, 
+                                     gender, 
+                                     ROW_NUMBER() OVER (PARTITION BY userId ORDER BY timestamp DESC) AS rn
+                              FROM staging_logs) staging_logs_ranked
+                        WHERE rn = 1
     """)
-    users = users.dropDuplicates(['userId', 'level'])
 
     # write users table to parquet files
     users.write.parquet(
         path=output_data + "/users/",
         mode="overwrite")
 
-    # extract columns to create time table
-    times = spark.sql("""
-                        SELECT DISTINCT start_time,
-                                        hour(start_time) AS hour, 
-                                        day(start_time) AS day, 
-                                        weekofyear(start_time) AS week, 
-                                        month(start_time) AS month, 
-                                        year (start_time) AS year, 
-                                        weekday(start_time) AS weekday 
-                        FROM staging_logs
-    """)
-
-    # write time table to parquet files partitioned by year and month
-    times.write.partitionBy("year", "month").parquet(
+    # extract columns to create time table, computing date parts from the timestamp column once per start time
+    times = df_log_data.select("start_time", "timestamp") \
+        .dropDuplicates(["start_time"]) \
+        .select("start_time",
+                hour("timestamp").alias("hour"),
+                dayofmonth("timestamp").alias("day"),
+                weekofyear("timestamp").alias("week"),
+                month("timestamp").alias("month"),
+                year("timestamp").alias("year"),
+                expr("weekday(timestamp)").alias("weekday"))
+
+    # write time table to parquet files partitioned by year and month, one file per partition
+    times.repartition("year", "month").write.partitionBy("year", "month").parquet(
         path=output_data + "/time/",
         mode="overwrite")
 
-    # read in song data to use for songplays table
-    df_song_data = get_song_data_df(input_data, spark)
-
-    # prepare view to use SparkSQL with
+    # prepare view to use SparkSQL with, backed by song data persisted by the caller
     df_song_data.createOrReplaceTempView("staging_songs")
 
     # extract columns from joined song and log datasets to create songplays table
+    # song data is much smaller than log data, so broadcast it instead of shuffling both sides
     songplays = spark.sql("""
-                            SELECT  l.start_time, 
+                            SELECT  /*+ BROADCAST(r) */
+                                    xxhash64(l.userId, l.sessionId, l.itemInSession, r.song_id) AS songplay_id, 
+                                    l.start_time, 
                                     l.userId, 
                                     l.level, 
                                     r.song_id, 
@@ -133,85 +178,110 @@ def process_log_data(spark, input_data, output_data):
                             FROM staging_logs AS l 
                             INNER JOIN staging_songs AS r 
                             ON l.song = r.title
-    """).withColumn('songplay_id', monotonically_increasing_id())
+    """)
 
-    # write songplays table to parquet files partitioned by year and month
-    songplays.write.partitionBy("year", "month").parquet(
+    # write songplays table to parquet files partitioned by year and month, one file per partition
+    # rebalance lets adaptive execution split partitions larger than the advisory size into several files
+    songplays.hint("rebalance", "year", "month").write.partitionBy("year", "month").parquet(
         path=output_data + "/songplays/",
         mode="overwrite")
 
+    df_log_data.unpersist()
 
-def get_song_data_df(input_data, spark):
+
+def staging_data_exists(spark, staging_path):
     """
-    This function uses spark session to read in the data and returns dataframe with proper types.
+    This function checks whether staging data at specified path was completely written by a previous run.
+
+    Args:
+        spark: spark session
+        staging_path: path to staging data directory
+    Returns:
+        True if staging data directory contains _SUCCESS marker, False otherwise
+    """
+    jvm = spark.sparkContext._jvm
+    success_path = jvm.org.apache.hadoop.fs.Path(staging_path + "_SUCCESS")
+    fs = success_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+    return fs.exists(success_path)
+
+
+def bootstrap_parquet(spark, input_data, staging_data):
+    """
+    This function converts raw JSON song and log data into parquet files in staging path.
+    Conversion is done only once, completely written staging data is left untouched on subsequent runs.
 
     Args:
+        spark: spark session
         input_data: path to input data
+        staging_data: path to staging data
+    Returns:
+        None
+    """
+    # convert song data unless a previous run already did, checked before reading so raw data is not listed
+    if staging_data_exists(spark, staging_data + "/songs_raw/"):
+        print("Song data already converted to parquet in staging path " + staging_data)
+    else:
+        print("Converting song data from input path " + input_data + " to parquet in staging path " + staging_data)
+
+        # read song data files, listing all nested directories at once, and write them to staging
+        # records that could not be parsed come through with empty song id and are dropped
+        df_song_data = spark.read \
+            .option("recursiveFileLookup", "true") \
+            .option("pathGlobFilter", "*.json") \
+            .json(input_data + "/song_data/",
+                  schema=SONG_DATA_SCHEMA) \
+            .filter(col("song_id").isNotNull())
+        df_song_data.write.parquet(
+            path=staging_data + "/songs_raw/",
+            mode="overwrite")
+
+    # convert log data unless a previous run already did, checked before reading so raw data is not listed
+    if staging_data_exists(spark, staging_data + "/logs_raw/"):
+        print("Log data already converted to parquet in staging path " + staging_data)
+    else:
+        print("Converting log data from input path " + input_data + " to parquet in staging path " + staging_data)
+
+        # read log data files, listing all nested directories at once, and write them to staging
+        # records with timestamp that could not be parsed come through with empty ts and are dropped
+        df_log_data = spark.read \
+            .option("recursiveFileLookup", "true") \
+            .option("pathGlobFilter", "*.json") \
+            .json(input_data + "log-data/",
+                  schema=LOG_DATA_SCHEMA) \
+            .filter(col("ts").isNotNull())
+        df_log_data.write.parquet(
+            path=staging_data + "/logs_raw/",
+            mode="overwrite")
+
+
+def get_song_data_df(staging_data, spark):
+    """
+    This function uses spark session to read in the data and returns dataframe with proper types.
+
+    Args:
+        staging_data: path to staging data
         spark: spark session
     Returns:
         df_song_data: dataframe of song data with proper types
     """
-    # get filepath to song data file
-    song_data = input_data + "/song_data/*/*/*"
-
-    # define song schema
-    df_song_schema = StructType([
-        StructField("artist_id", StringType()),
-        StructField("artist_latitude", DoubleType()),
-        StructField("artist_location", StringType()),
-        StructField("artist_longitude", DoubleType()),
-        StructField("artist_name", StringType()),
-        StructField("duration", DoubleType()),
-        StructField("num_songs", IntegerType()),
-        StructField("song_id", StringType()),
-        StructField("title", StringType()),
-        StructField("year", IntegerType())
-    ])
     # read song data file
-    df_song_data = spark.read.json(song_data,
-                                   schema=df_song_schema,
-                                   mode='DROPMALFORMED')
+    df_song_data = spark.read.schema(SONG_DATA_SCHEMA).parquet(staging_data + "/songs_raw/")
     return df_song_data
 
 
-def get_log_data_df(input_data, spark):
+def get_log_data_df(staging_data, spark):
     """
     This function uses spark session to read in the data and returns dataframe with proper types.
 
     Args:
-        input_data: path to input data
+        staging_data: path to staging data
         spark: spark session
     Returns:
-        df_song_data: dataframe of song data with proper types
+        df_log_data: dataframe of log data with proper types, filtered by actions for song plays
     """
-    # get filepath to log data file
-    log_data = input_data + "log-data/*/*/*"
-
-    # define log schema
-    df_log_schema = StructType([
-        StructField("artist", StringType()),
-        StructField("auth", StringType()),
-        StructField("firstName", StringType()),
-        StructField("gender", StringType()),
-        StructField("itemInSession", IntegerType()),
-        StructField("lastName", StringType()),
-        StructField("length", DoubleType()),
-        StructField("level", StringType()),
-        StructField("location", StringType()),
-        StructField("method", StringType()),
-        StructField("page", StringType()),
-        StructField("registration", DoubleType()),
-        StructField("sessionId", IntegerType()),
-        StructField("song", StringType()),
-        StructField("status", IntegerType()),
-        StructField("ts", LongType()),
-        StructField("userAgent", StringType()),
-        StructField("userId", StringType()),
-    ])
-    # read log data file
-    df_log_data = spark.read.json(log_data,
-                                  schema=df_log_schema,
-                                  mode='DROPMALFORMED')
+    # read log data file, filtering by actions for song plays right away so parquet can skip row groups
+    df_log_data = spark.read.schema(LOG_DATA_SCHEMA).parquet(staging_data + "/logs_raw/") \
+        .filter("page = 'NextSong'")
     return df_log_data
 
 
@@ -225,13 +295,11 @@ def enrich_log_data(df_log_data):
     Returns:
         df_log_data: log data dataframe
     """
-    # create timestamp column from original timestamp column
-    get_timestamp = udf(lambda t: datetime.fromtimestamp(t / 1000.0))
-    df_log_data = df_log_data.withColumn('timestamp', get_timestamp(df_log_data.ts))
+    # create timestamp column from original timestamp column (epoch milliseconds)
+    df_log_data = df_log_data.withColumn('timestamp', (col('ts') / 1000.0).cast('timestamp'))
 
-    # create datetime column from original timestamp column
-    get_datetime = udf(lambda x: str(x))
-    df_log_data = df_log_data.withColumn('start_time', get_datetime(df_log_data.timestamp))
+    # create datetime column from converted timestamp column
+    df_log_data = df_log_data.withColumn('start_time', col('timestamp').cast('string'))
     return df_log_data
 
 
@@ -244,9 +312,28 @@ def create_spark_session():
     """
     spark = SparkSession \
         .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.8.5") \
+        .config("spark.jars.packages",
+                "org.apache.hadoop:hadoop-aws:3.3.4,"
+                "org.apache.spark:spark-hadoop-cloud_2.12:" + pyspark_version) \
+        .config("spark.hadoop.fs.s3a.committer.name", "magic") \
+        .config("spark.hadoop.fs.s3a.committer.magic.enabled", "true") \
+        .config("spark.hadoop.fs.s3a.experimental.input.fadvise", "sequential") \
+        .config("spark.hadoop.parquet.compression.codec.zstd.level", "3") \
+        .config("spark.serializer", "org.apache.spark.serializer.KryoSerializer") \
+        .config("spark.kryo.registrationRequired", "false") \
+        .config("spark.memory.offHeap.enabled", "true") \
+        .config("spark.memory.offHeap.size", "2g") \
         .getOrCreate()
-    spark.conf.set("mapreduce.fileoutputcommitter.algorithm.version", "2")
+    spark.conf.set("spark.sql.sources.commitProtocolClass",
+                   "org.apache.spark.internal.io.cloud.PathOutputCommitProtocol")
+    spark.conf.set("spark.sql.parquet.output.committer.class",
+                   "org.apache.spark.internal.io.cloud.BindingParquetOutputCommitter")
+    spark.conf.set("spark.sql.autoBroadcastJoinThreshold", str(256 * 1024 * 1024))
+    spark.conf.set("spark.sql.parquet.compression.codec", "zstd")
+    spark.conf.set("spark.sql.adaptive.enabled", "true")
+    spark.conf.set("spark.sql.adaptive.skewJoin.enabled", "true")
+    spark.conf.set("spark.sql.adaptive.coalescePartitions.enabled", "true")
+    spark.conf.set("spark.sql.adaptive.advisoryPartitionSizeInBytes", "128m")
     return spark
 
 
@@ -270,10 +357,22 @@ def main():
     spark = create_spark_session()
 
     input_data = config['INPUT']['INPUT_ROOT_PATH']
+    staging_data = config['STAGING']['STAGING_ROOT_PATH']
     output_data = config['OUTPUT']['OUTPUT_ROOT_PATH']
 
-    process_song_data(spark, input_data, output_data)
-    process_log_data(spark, input_data, output_data)
+    bootstrap_parquet(spark, input_data, staging_data)
+
+    # read song data once and keep it around, as both song and log processing need it
+    print("Reading song data from staging path " + staging_data)
+    df_song_data = get_song_data_df(staging_data, spark).persist(StorageLevel.MEMORY_AND_DISK)
+
+    print("Reading log data from staging path " + staging_data)
+    df_log_data = get_log_data_df(staging_data, spark)
+
+    process_song_data(spark, df_song_data, output_data)
+    process_log_data(spark, df_song_data, df_log_data, output_data)
+
+    df_song_data.unpersist()
 
 
 if __name__ == "__main__":